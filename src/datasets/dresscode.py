@@ -4,6 +4,7 @@ import json
 import pathlib
 import random
 import sys
+from functools import lru_cache
 from typing import Tuple
 
 PROJECT_ROOT = pathlib.Path(__file__).absolute().parents[2].absolute()
@@ -13,16 +14,72 @@ import cv2
 import numpy as np
 import torch
 import torch.utils.data as data
-import torchvision.transforms as transforms
-from PIL import Image, ImageDraw, ImageOps
+from PIL import Image, ImageDraw
 from torchvision.ops import masks_to_boxes
 from src.utils.labelmap import label_map
-from src.utils.posemap import kpoint_to_heatmap
+from src.utils.posemap import kpoints_to_heatmaps
 
 import torchvision
 import torchvision.transforms as T
 from datetime import datetime
 
+# label ids of each mask group, so that every mask is built with a single np.isin pass
+_HEAD_IDS = np.array([label_map[k] for k in ("hat", "hair", "sunglasses", "head")], dtype=np.uint8)
+_ARMS_IDS = np.array([label_map["left_arm"], label_map["right_arm"]], dtype=np.uint8)
+_FIXED_IDS = np.array([label_map[k] for k in ("hair", "left_shoe", "right_shoe", "hat", "sunglasses", "scarf", "bag")],
+                      dtype=np.uint8)
+_CATEGORY_FIXED_IDS = {
+    'dresses': _FIXED_IDS,
+    'upper_body': np.append(_FIXED_IDS, [label_map["skirt"], label_map["pants"]]).astype(np.uint8),
+    'lower_body': np.append(_FIXED_IDS, [label_map["upper_clothes"], label_map["left_arm"],
+                                         label_map["right_arm"]]).astype(np.uint8),
+}
+_CATEGORY_CLOTH_IDS = {
+    'dresses': np.array([label_map["dress"]], dtype=np.uint8),
+    'upper_body': np.array([label_map["upper_clothes"]], dtype=np.uint8),
+    'lower_body': np.array([label_map["pants"]], dtype=np.uint8),
+}
+_CATEGORY_MASK_IDS = {
+    'dresses': np.array([label_map[k] for k in ("dress", "left_leg", "right_leg")], dtype=np.uint8),
+    'upper_body': np.array([label_map["upper_clothes"]], dtype=np.uint8),
+    'lower_body': np.array([label_map[k] for k in ("pants", "left_leg", "right_leg")], dtype=np.uint8),
+}
+
+
+# a 512x384 label map is ~200 KB, so this bounds the cache to ~50 MB per DataLoader worker
+@lru_cache(maxsize=256)
+def _load_parse(path: str, size: Tuple[int, int]) -> np.ndarray:
+    """
+    Load the label map at path resized to size (width, height). The result is cached per DataLoader worker,
+    so the returned array is shared between calls and must not be modified in place. The uncached loader
+    is available as _load_parse.__wrapped__
+    """
+    # label maps are palette images, Pillow gives back the raw label indices where cv2.imread would expand
+    # the palette to colors, the resize is done by OpenCV with the same pixel centers as Image.NEAREST
+    parse_array = np.asarray(Image.open(path))
+    return cv2.resize(parse_array, size, interpolation=cv2.INTER_NEAREST_EXACT)
+
+
+@lru_cache(maxsize=2048)
+def _load_pose(path: str) -> np.ndarray:
+    """
+    Load the keypoints json at path as a (num_keypoints, 4) array. The result is cached per DataLoader worker,
+    so the returned array is shared between calls and must not be modified in place. The uncached loader
+    is available as _load_pose.__wrapped__
+    """
+    with open(path, 'r') as f:
+        pose_label = json.load(f)
+    return np.array(pose_label['keypoints']).reshape((-1, 4))
+
+
+def _pil_l_to_tensor(img: Image.Image) -> torch.Tensor:
+    """
+    Convert a single channel PIL image to a 1xHxW float tensor in [0,1], same as transforms.functional.to_tensor
+    without its generic dispatch and intermediate copies
+    """
+    return torch.from_numpy(np.array(img, dtype=np.uint8)).to(torch.float32).div_(255.0).unsqueeze(0)
+
+
 class DressCodeDataset(data.Dataset):
     def __init__(self,
                  dataroot_path: str,
@@ -41,6 +98,7 @@ class DressCodeDataset(data.Dataset):
                                            'original_captions', 'category', 'stitch_label'),
                  category: Tuple[str] = ('dresses', 'upper_body', 'lower_body'),
                  size: Tuple[int, int] = (512, 384),
+                 cache_annotations: bool = False,
                  ):
 
         super(DressCodeDataset, self).__init__()
@@ -56,20 +114,16 @@ class DressCodeDataset(data.Dataset):
         self.width = size[1]
         self.radius = radius
         self.tokenizer = tokenizer
-        self.transform = transforms.Compose([
-            transforms.ToTensor(),
-            transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
-        ])
-        self.transform2D = transforms.Compose([
-            transforms.ToTensor(),
-            transforms.Normalize((0.5,), (0.5,))
-        ])
+        # label maps and keypoints are only reused across epochs, e.g. training with persistent_workers
+        self.cache_annotations = cache_annotations
         self.order = order
+        # five 5x5 dilations are equivalent to a single 21x21 one
+        self._dilate_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (21, 21))
 
         im_names = []
         c_names = []
-        dataroot_names = []
-        multimodal_data_path_names = []
+        category_idx = []
+        self._cat_to_idx = {c: i for i, c in enumerate(category)}
 
         possible_outputs = ['c_name', 'im_name', 'cloth', 'image', 'im_cloth', 'shape', 'im_head', 'im_pose',
                             'pose_map', 'parse_array', 'dense_labels', 'dense_uv', 'skeleton',
@@ -78,6 +132,19 @@ class DressCodeDataset(data.Dataset):
 
         assert all(x in possible_outputs for x in outputlist)
 
+        # which parts of __getitem__ have to run for the requested outputs
+        outputs = set(outputlist)
+        self._need_captions = "captions" in outputs
+        self._need_any_captions = bool(outputs & {"captions", "original_captions"})
+        self._need_image = bool(outputs & {"image", "im_head", "im_cloth"})
+        self._need_sketch = "im_sketch" in outputs
+        self._need_parse = bool(outputs & {"im_pose", "parser_mask", "im_mask", "parse_mask_total", "parse_array",
+                                           "pose_map", "shape", "im_head"})
+        self._need_im_head = "im_head" in outputs
+        self._need_im_cloth = "im_cloth" in outputs
+        self._need_im_pose = "im_pose" in outputs
+        self._need_stitch_label = "stitch_label" in outputs
+
         # Load Captions
         with open(self.multimodal_data_path / self.caption_folder) as f:
             self.captions_dict = json.load(f)
@@ -90,7 +157,6 @@ class DressCodeDataset(data.Dataset):
             assert c in ['dresses', 'upper_body', 'lower_body']
 
             dataroot = self.dataroot / c
-            multimodal_data_path = self.multimodal_data_path / c
 
             if phase == 'train':
                 filename = dataroot / f"{phase}_pairs.txt"
@@ -112,8 +178,7 @@ class DressCodeDataset(data.Dataset):
 
                         im_names.append(im_name)
                         c_names.append(c_name)
-                        dataroot_names.append(dataroot)
-                        multimodal_data_path_names.append(multimodal_data_path)
+                        category_idx.append(self._cat_to_idx[c])
 
 
                         i += 1
@@ -126,13 +191,27 @@ class DressCodeDataset(data.Dataset):
 
                         im_names.append(im_name)
                         c_names.append(c_name)
-                        dataroot_names.append(dataroot)
-                        multimodal_data_path_names.append(multimodal_data_path)
-
-        self.im_names = im_names
-        self.c_names = c_names
-        self.dataroot_names = dataroot_names
-        self.multimodal_data_path_names = multimodal_data_path_names
+                        category_idx.append(self._cat_to_idx[c])
+
+        # captions are not shuffled outside of training, so they can all be tokenized at once
+        self._cap_ids = {}
+        if phase != 'train' and self._need_captions:
+            cap_keys = sorted({c.split('_')[0] for c in c_names})
+            if cap_keys:
+                cap_ids = self.tokenizer([", ".join(self.captions_dict[k]) for k in cap_keys],
+                                         max_length=self.tokenizer.model_max_length, padding="max_length",
+                                         truncation=True, return_tensors="pt").input_ids
+                self._cap_ids = {k: ids.clone() for k, ids in zip(cap_keys, cap_ids)}
+
+        # fixed-width unicode arrays hold the filenames inline, without one str object per sample whose
+        # refcount updates would trigger copy-on-write of the pages in every DataLoader worker
+        self.im_names = np.array(im_names, dtype=str)
+        self.c_names = np.array(c_names, dtype=str)
+        # per-sample category index into the per-category path tables
+        self._category_idx = np.asarray(category_idx, dtype=np.int8)
+        self._dataroots = tuple(self.dataroot / c for c in category)
+        self._multimodal_data_paths = tuple(self.multimodal_data_path / c for c in category)
+        self._categories_str = tuple(str(p.name) for p in self._dataroots)
 
     def __getitem__(self, index):
         """
@@ -143,14 +222,17 @@ class DressCodeDataset(data.Dataset):
         :rtype: dict
         """
 
-        c_name = self.c_names[index]
-        im_name = self.im_names[index]
-        dataroot = self.dataroot_names[index]
-        multimodal_data_path = self.multimodal_data_path_names[index]
+        c_name = str(self.c_names[index])
+        im_name = str(self.im_names[index])
+        ci = self._category_idx[index]
+        dataroot = self._dataroots[ci]
+        multimodal_data_path = self._multimodal_data_paths[ci]
+        category = self._categories_str[ci]
+        result = {'c_name': c_name, 'im_name': im_name, 'category': category}
 
         sketch_threshold = random.randint(self.sketch_threshold_range[0], self.sketch_threshold_range[1])
 
-        if "captions" in self.outputlist or "original_captions" in self.outputlist:
+        if self._need_any_captions:
             captions = self.captions_dict[c_name.split('_')[0]]
             # if train randomly shuffle captions if there are multiple, else concatenate with comma
             if self.phase == 'train':
@@ -158,229 +240,166 @@ class DressCodeDataset(data.Dataset):
             captions = ", ".join(captions)
 
             original_captions = captions
+            result['original_captions'] = original_captions
 
-        if "captions" in self.outputlist:
-            cond_input = self.tokenizer([captions], max_length=self.tokenizer.model_max_length, padding="max_length",
-                                        truncation=True, return_tensors="pt").input_ids
-            cond_input = cond_input.squeeze(0)
-            max_length = cond_input.shape[-1]
-            uncond_input = self.tokenizer(
-                [""], padding="max_length", max_length=max_length, return_tensors="pt"
-            ).input_ids.squeeze(0)
-            captions = cond_input
-
-        if "image" in self.outputlist or "im_head" in self.outputlist or "im_cloth" in self.outputlist:
-            image = Image.open(dataroot / 'images' / im_name)
+        if self._need_captions:
+            if self.phase == 'train':
+                cond_input = self.tokenizer([captions], max_length=self.tokenizer.model_max_length,
+                                            padding="max_length", truncation=True, return_tensors="pt").input_ids
+                captions = cond_input.squeeze(0)
+            else:
+                captions = self._cap_ids[c_name.split('_')[0]]
+            result['captions'] = captions
 
+        if self._need_image:
+            image = Image.open(f'{dataroot}/images/{im_name}')
+            # let libjpeg decode directly at the closest scale above the target size
+            image.draft('RGB', (self.width, self.height))
             image = image.resize((self.width, self.height))
-            image = self.transform(image)  # [-1,1]
+            image = torch.from_numpy(np.array(image)).permute(2, 0, 1).to(torch.float32).div_(127.5).sub_(1)  # [-1,1]
+            result['image'] = image
 
-        if "im_sketch" in self.outputlist:
+        if self._need_sketch:
 
             if "unpaired" == self.order and self.phase == 'test':  # Upper of multigarment is the same of unpaired
-                im_sketch = Image.open(
-                    multimodal_data_path / 'im_sketch_unpaired' / f'{im_name.replace(".jpg", "")}_{c_name.replace(".jpg", ".png")}')
+                sketch_path = f'{multimodal_data_path}/im_sketch_unpaired/{im_name.replace(".jpg", "")}_{c_name.replace(".jpg", ".png")}'
             else:
-                im_sketch = Image.open(multimodal_data_path / 'im_sketch' / c_name.replace(".jpg", ".png"))
-
-            im_sketch = im_sketch.resize((self.width, self.height))
-            im_sketch = ImageOps.invert(im_sketch)
-            # threshold grayscale pil image
-            im_sketch = im_sketch.point(lambda p: 255 if p > sketch_threshold else 0)
-            # im_sketch = im_sketch.convert("RGB")
-            im_sketch = transforms.functional.to_tensor(im_sketch)  # [-1,1]
-            im_sketch = 1 - im_sketch
-
-        if "im_pose" in self.outputlist or "parser_mask" in self.outputlist or "im_mask" in self.outputlist or "parse_mask_total" in self.outputlist or "parse_array" in self.outputlist or "pose_map" in self.outputlist or "parse_array" in self.outputlist or "shape" in self.outputlist or "im_head" in self.outputlist:
+                sketch_path = f'{multimodal_data_path}/im_sketch/{c_name.replace(".jpg", ".png")}'
+
+            # keep Pillow's antialiased bicubic resample, the filter decides which edge pixels pass the threshold
+            im_sketch = Image.open(sketch_path).resize((self.width, self.height), Image.BICUBIC)
+            im_sketch = np.asarray(im_sketch)
+            # threshold the inverted grayscale image and invert back, (255 - p <= t) == (p >= 255 - t)
+            im_sketch = im_sketch >= 255 - sketch_threshold
+            # binary, so float16 is lossless and halves the transfer to the main process and the GPU
+            im_sketch = torch.from_numpy(im_sketch).to(torch.float16).unsqueeze(0)
+            result['im_sketch'] = im_sketch
+
+        if self._need_parse:
             # Label Map
             parse_name = im_name.replace('_0.jpg', '_4.png')
-            im_parse = Image.open(dataroot / 'label_maps' / parse_name)
-            im_parse = im_parse.resize((self.width, self.height), Image.NEAREST)
-            parse_array = np.array(im_parse)
-
-            parse_shape = (parse_array > 0).astype(np.float32)
-
-            parse_head = (parse_array == 1).astype(np.float32) + \
-                         (parse_array == 2).astype(np.float32) + \
-                         (parse_array == 3).astype(np.float32) + \
-                         (parse_array == 11).astype(np.float32)
-
-            parser_mask_fixed = (parse_array == label_map["hair"]).astype(np.float32) + \
-                                (parse_array == label_map["left_shoe"]).astype(np.float32) + \
-                                (parse_array == label_map["right_shoe"]).astype(np.float32) + \
-                                (parse_array == label_map["hat"]).astype(np.float32) + \
-                                (parse_array == label_map["sunglasses"]).astype(np.float32) + \
-                                (parse_array == label_map["scarf"]).astype(np.float32) + \
-                                (parse_array == label_map["bag"]).astype(np.float32)
-
-            parser_mask_changeable = (parse_array == label_map["background"]).astype(np.float32)
-
-            arms = (parse_array == 14).astype(np.float32) + (parse_array == 15).astype(np.float32)
-
-            category = str(dataroot.name)
-            if category == 'dresses':
-                label_cat = 7
-                parse_cloth = (parse_array == 7).astype(np.float32)
-                parse_mask = (parse_array == 7).astype(np.float32) + \
-                             (parse_array == 12).astype(np.float32) + \
-                             (parse_array == 13).astype(np.float32)
-                parser_mask_changeable += np.logical_and(parse_array, np.logical_not(parser_mask_fixed))
-
-            elif category == 'upper_body':
-                label_cat = 4
-                parse_cloth = (parse_array == 4).astype(np.float32)
-                parse_mask = (parse_array == 4).astype(np.float32)
-
-                parser_mask_fixed += (parse_array == label_map["skirt"]).astype(np.float32) + \
-                                     (parse_array == label_map["pants"]).astype(np.float32)
-
-                parser_mask_changeable += np.logical_and(parse_array, np.logical_not(parser_mask_fixed))
-            elif category == 'lower_body':
-                label_cat = 6
-                parse_cloth = (parse_array == 6).astype(np.float32)
-                parse_mask = (parse_array == 6).astype(np.float32) + \
-                             (parse_array == 12).astype(np.float32) + \
-                             (parse_array == 13).astype(np.float32)
-
-                parser_mask_fixed += (parse_array == label_map["upper_clothes"]).astype(np.float32) + \
-                                     (parse_array == 14).astype(np.float32) + \
-                                     (parse_array == 15).astype(np.float32)
-                parser_mask_changeable += np.logical_and(parse_array, np.logical_not(parser_mask_fixed))
-            else:
-                raise NotImplementedError
-
-            parse_head = torch.from_numpy(parse_head)  # [0,1]
-            parse_cloth = torch.from_numpy(parse_cloth)  # [0,1]
-            parse_mask = torch.from_numpy(parse_mask)  # [0,1]
+            load_parse = _load_parse if self.cache_annotations else _load_parse.__wrapped__
+            parse_array = load_parse(f'{dataroot}/label_maps/{parse_name}', (self.width, self.height))
+            # never hand out the cached array itself
+            result['parse_array'] = parse_array.copy() if self.cache_annotations else parse_array
+
+            parse_shape = parse_array.astype(bool, copy=False)
+            parse_head = np.isin(parse_array, _HEAD_IDS)
+            parser_mask_fixed = np.isin(parse_array, _CATEGORY_FIXED_IDS[category])
+            parser_mask_changeable = parse_array == label_map["background"]
+            arms = np.isin(parse_array, _ARMS_IDS)
+            parse_cloth = np.isin(parse_array, _CATEGORY_CLOTH_IDS[category])
+            parse_mask = np.isin(parse_array, _CATEGORY_MASK_IDS[category])
+            parser_mask_changeable |= np.logical_and(parse_array, np.logical_not(parser_mask_fixed))
+
+            # the binary masks are kept as bool tensors from here on
+            parse_mask = torch.from_numpy(parse_mask)
             parser_mask_fixed = torch.from_numpy(parser_mask_fixed)
             parser_mask_changeable = torch.from_numpy(parser_mask_changeable)
 
-            # dilation
-            parse_without_cloth = np.logical_and(parse_shape, np.logical_not(parse_mask))
-            parse_mask = parse_mask.cpu().numpy()
+            parse_head = torch.from_numpy(parse_head.view(np.uint8)).to(torch.float32)  # [0,1]
+            parse_cloth = torch.from_numpy(parse_cloth.view(np.uint8)).to(torch.float32)  # [0,1]
 
-            if "im_head" in self.outputlist:
+            if self._need_im_head:
                 # Masked cloth
                 im_head = image * parse_head - (1 - parse_head)
-            if "im_cloth" in self.outputlist:
+                result['im_head'] = im_head
+            if self._need_im_cloth:
                 im_cloth = image * parse_cloth + (1 - parse_cloth)
+                result['im_cloth'] = im_cloth
 
             # Shape
-            parse_shape = Image.fromarray((parse_shape * 255).astype(np.uint8))
+            parse_shape = Image.fromarray(parse_shape.view(np.uint8) * 255)
             parse_shape = parse_shape.resize((self.width // 16, self.height // 16), Image.BILINEAR)
             parse_shape = parse_shape.resize((self.width, self.height), Image.BILINEAR)
-            shape = self.transform2D(parse_shape)  # [-1,1]
+            shape = _pil_l_to_tensor(parse_shape).sub_(0.5).mul_(2.0).to(torch.float16)  # [-1,1]
+            result['shape'] = shape
 
             # Load pose points
             pose_name = im_name.replace('_0.jpg', '_2.json')
-            with open(dataroot / 'keypoints' / pose_name, 'r') as f:
-                pose_label = json.load(f)
-                pose_data = pose_label['keypoints']
-                pose_data = np.array(pose_data)
-                pose_data = pose_data.reshape((-1, 4))
-
-            point_num = pose_data.shape[0]
-            pose_map = torch.zeros(point_num, self.height, self.width)
-            r = self.radius * (self.height / 512.0)
-            im_pose = Image.new('L', (self.width, self.height))
-            pose_draw = ImageDraw.Draw(im_pose)
-            neck = Image.new('L', (self.width, self.height))
-            neck_draw = ImageDraw.Draw(neck)
-            for i in range(point_num):
-                one_map = Image.new('L', (self.width, self.height))
-                draw = ImageDraw.Draw(one_map)
-                point_x = np.multiply(pose_data[i, 0], self.width / 384.0)
-                point_y = np.multiply(pose_data[i, 1], self.height / 512.0)
-                if point_x > 1 and point_y > 1:
-                    draw.rectangle((point_x - r, point_y - r, point_x + r, point_y + r), 'white', 'white')
-                    pose_draw.rectangle((point_x - r, point_y - r, point_x + r, point_y + r), 'white', 'white')
-                    if i == 2 or i == 5:
-                        neck_draw.ellipse((point_x - r * 4, point_y - r * 4, point_x + r * 4, point_y + r * 4), 'white',
-                                          'white')
-                one_map = self.transform2D(one_map)
-                pose_map[i] = one_map[0]
-
-            d = []
-            for pose_d in pose_data:
-                ux = pose_d[0] / 384.0
-                uy = pose_d[1] / 512.0
-
-                # scale posemap points
-                px = ux * self.width
-                py = uy * self.height
-
-                d.append(kpoint_to_heatmap(np.array([px, py]), (self.height, self.width), 9))
-
-            pose_map = torch.stack(d)
-
-            # just for visualization
-            im_pose = self.transform2D(im_pose)
+            load_pose = _load_pose if self.cache_annotations else _load_pose.__wrapped__
+            pose_data = load_pose(f'{dataroot}/keypoints/{pose_name}')
+
+            # scale posemap points
+            points = pose_data[:, :2] * np.array([self.width / 384.0, self.height / 512.0])
+
+            if self._need_im_pose:
+                # just for visualization
+                r = self.radius * (self.height / 512.0)
+                im_pose = np.zeros((self.height, self.width), dtype=np.uint8)
+                for point_x, point_y in points:
+                    if point_x > 1 and point_y > 1:
+                        im_pose[max(0, int(point_y - r)):int(point_y + r) + 1,
+                                max(0, int(point_x - r)):int(point_x + r) + 1] = 1
+                im_pose = torch.from_numpy(im_pose).to(torch.float32).mul_(2).sub_(1).unsqueeze(0)  # [-1,1]
+                result['im_pose'] = im_pose
+
+            # gaussians in [0,1], float16 halves the largest tensor of the sample
+            pose_map = kpoints_to_heatmaps(points, (self.height, self.width), 9).to(torch.float16).contiguous()
+            result['pose_map'] = pose_map
 
             im_arms = Image.new('L', (self.width, self.height))
             arms_draw = ImageDraw.Draw(im_arms)
             if category == 'dresses' or category == 'upper_body' or category == 'lower_body':
-                with open(dataroot / 'keypoints' / pose_name, 'r') as f:
-                    data = json.load(f)
-                    shoulder_right = np.multiply(tuple(data['keypoints'][2][:2]), self.height / 512.0)
-                    shoulder_left = np.multiply(tuple(data['keypoints'][5][:2]), self.height / 512.0)
-                    elbow_right = np.multiply(tuple(data['keypoints'][3][:2]), self.height / 512.0)
-                    elbow_left = np.multiply(tuple(data['keypoints'][6][:2]), self.height / 512.0)
-                    wrist_right = np.multiply(tuple(data['keypoints'][4][:2]), self.height / 512.0)
-                    wrist_left = np.multiply(tuple(data['keypoints'][7][:2]), self.height / 512.0)
-                    if wrist_right[0] <= 1. and wrist_right[1] <= 1.:
-                        if elbow_right[0] <= 1. and elbow_right[1] <= 1.:
-                            arms_draw.line(
-                                np.concatenate((wrist_left, elbow_left, shoulder_left, shoulder_right)).astype(
-                                    np.uint16).tolist(), 'white', 45, 'curve')
-                        else:
-                            arms_draw.line(np.concatenate(
-                                (wrist_left, elbow_left, shoulder_left, shoulder_right, elbow_right)).astype(
+                shoulder_right = np.multiply(pose_data[2, :2], self.height / 512.0)
+                shoulder_left = np.multiply(pose_data[5, :2], self.height / 512.0)
+                elbow_right = np.multiply(pose_data[3, :2], self.height / 512.0)
+                elbow_left = np.multiply(pose_data[6, :2], self.height / 512.0)
+                wrist_right = np.multiply(pose_data[4, :2], self.height / 512.0)
+                wrist_left = np.multiply(pose_data[7, :2], self.height / 512.0)
+                if wrist_right[0] <= 1. and wrist_right[1] <= 1.:
+                    if elbow_right[0] <= 1. and elbow_right[1] <= 1.:
+                        arms_draw.line(
+                            np.concatenate((wrist_left, elbow_left, shoulder_left, shoulder_right)).astype(
                                 np.uint16).tolist(), 'white', 45, 'curve')
-                    elif wrist_left[0] <= 1. and wrist_left[1] <= 1.:
-                        if elbow_left[0] <= 1. and elbow_left[1] <= 1.:
-                            arms_draw.line(
-                                np.concatenate((shoulder_left, shoulder_right, elbow_right, wrist_right)).astype(
-                                    np.uint16).tolist(), 'white', 45, 'curve')
-                        else:
-                            arms_draw.line(np.concatenate(
-                                (elbow_left, shoulder_left, shoulder_right, elbow_right, wrist_right)).astype(
+                    else:
+                        arms_draw.line(np.concatenate(
+                            (wrist_left, elbow_left, shoulder_left, shoulder_right, elbow_right)).astype(
+                            np.uint16).tolist(), 'white', 45, 'curve')
+                elif wrist_left[0] <= 1. and wrist_left[1] <= 1.:
+                    if elbow_left[0] <= 1. and elbow_left[1] <= 1.:
+                        arms_draw.line(
+                            np.concatenate((shoulder_left, shoulder_right, elbow_right, wrist_right)).astype(
                                 np.uint16).tolist(), 'white', 45, 'curve')
                     else:
                         arms_draw.line(np.concatenate(
-                            (wrist_left, elbow_left, shoulder_left, shoulder_right, elbow_right, wrist_right)).astype(
+                            (elbow_left, shoulder_left, shoulder_right, elbow_right, wrist_right)).astype(
                             np.uint16).tolist(), 'white', 45, 'curve')
+                else:
+                    arms_draw.line(np.concatenate(
+                        (wrist_left, elbow_left, shoulder_left, shoulder_right, elbow_right, wrist_right)).astype(
+                        np.uint16).tolist(), 'white', 45, 'curve')
 
                 hands = np.logical_and(np.logical_not(im_arms), arms)
+                result['hands'] = hands
 
                 if category == 'dresses' or category == 'upper_body':
-                    parse_mask += im_arms
-                    parser_mask_fixed += hands
+                    parse_mask |= torch.from_numpy(np.asarray(im_arms, dtype=bool))
+                    parser_mask_fixed |= torch.from_numpy(hands)
 
             # delete neck
             parse_head_2 = torch.clone(parse_head)
             if category == 'dresses' or category == 'upper_body':
-                with open(dataroot / 'keypoints' / pose_name, 'r') as f:
-                    data = json.load(f)
-                    points = []
-                    points.append(np.multiply(tuple(data['keypoints'][2][:2]), self.height / 512.0))
-                    points.append(np.multiply(tuple(data['keypoints'][5][:2]), self.height / 512.0))
-                    x_coords, y_coords = zip(*points)
-                    A = np.vstack([x_coords, np.ones(len(x_coords))]).T
-                    m, c = np.linalg.lstsq(A, y_coords, rcond=None)[0]
-                    for i in range(parse_array.shape[1]):
-                        y = i * m + c
-                        parse_head_2[int(y - 20 * (self.height / 512.0)):, i] = 0
-
-            parser_mask_fixed = np.logical_or(parser_mask_fixed, np.array(parse_head_2, dtype=np.uint16))
-            parse_mask += np.logical_or(parse_mask, np.logical_and(np.array(parse_head, dtype=np.uint16),
-                                                                   np.logical_not(
-                                                                       np.array(parse_head_2, dtype=np.uint16))))
+                # line through the two shoulders
+                (x1, y1), (x2, y2) = pose_data[[2, 5], :2] * (self.height / 512.0)
+                m = (y2 - y1) / (x2 - x1 + 1e-8)
+                c = y1 - m * x1
+                # first deleted row of each column, truncated like int() and with negative values
+                # counting from the bottom as a slice start would
+                ys = np.arange(self.width) * m + c - 20 * (self.height / 512.0)
+                ys = np.clip(ys, -self.height, self.height).astype(np.int64)
+                ys[ys < 0] += self.height
+                rows = torch.arange(self.height)[:, None]
+                parse_head_2.masked_fill_(rows >= torch.from_numpy(ys)[None, :], 0)
+            result['parse_head_2'] = parse_head_2
+
+            parser_mask_fixed |= parse_head_2.bool()
+            parse_mask |= parse_head.bool() & ~parse_head_2.bool()
 
             # tune the amount of dilation here
-            parse_mask = cv2.dilate(parse_mask, np.ones((5, 5), np.uint16), iterations=5)
-            parse_mask = np.logical_and(parser_mask_changeable, np.logical_not(parse_mask))
-            parse_mask_total = np.logical_or(parse_mask, parser_mask_fixed)
-            im_mask = image * parse_mask_total
+            parse_mask = cv2.dilate(parse_mask.numpy().view(np.uint8), self._dilate_kernel, iterations=1)
+            parse_mask = parser_mask_changeable & ~torch.from_numpy(parse_mask.view(bool))
+            parse_mask_total = (parse_mask | parser_mask_fixed).to(torch.uint8)
             inpaint_mask = 1 - parse_mask_total
 
             # here we have to modify the mask and get the bounding box
@@ -397,10 +416,13 @@ class DressCodeDataset(data.Dataset):
 
             inpaint_mask = inpaint_mask.unsqueeze(0)
             original_inpaint_mask = torch.tensor(inpaint_mask)
-            im_mask = image * np.logical_not(inpaint_mask.repeat(3, 1, 1))
+            im_mask = image.masked_fill(inpaint_mask.bool(), 0)
             parse_mask_total = parse_mask_total.numpy()
             parse_mask_total = parse_array * parse_mask_total
             parse_mask_total = torch.from_numpy(parse_mask_total)
+            result['im_mask'] = im_mask
+            result['inpaint_mask'] = inpaint_mask
+            result['parse_mask_total'] = parse_mask_total
 
             # un mask hand
             # inpaint_mask = np.logical_and(inpaint_mask, 1 - arms.astype(np.uint8))
@@ -419,14 +441,10 @@ class DressCodeDataset(data.Dataset):
                 img = transform(temp_inpaint_mask)
                 img.save("new_" + time + ".jpg")
 
-        if "stitch_label" in self.outputlist:
+        if self._need_stitch_label:
             stitch_labelmap = Image.open(self.multimodal_data_path / 'test_stitch_map' / im_name.replace(".jpg", ".png"))
-            stitch_labelmap = transforms.ToTensor()(stitch_labelmap) * 255
-            stitch_label = stitch_labelmap == 13
-
-        result = {}
-        for k in self.outputlist:
-            result[k] = vars()[k]
+            stitch_label = torch.from_numpy(np.array(stitch_labelmap) == 13).unsqueeze(0)
+            result['stitch_label'] = stitch_label
 
         # Output interpretation
         # "c_name" -> filename of inshop cloth
@@ -438,7 +456,7 @@ class DressCodeDataset(data.Dataset):
         # "cloth_sketch" -> sketch of the inshop cloth
         # "im_sketch" -> sketch of "im_cloth"
         # ...
-        return result
+        return {k: result[k] for k in self.outputlist}
 
     def __len__(self):
         return len(self.c_names)
@@ -121,6 +121,7 @@ def main() -> None:
         shuffle=False,
         batch_size=args.batch_size,
         num_workers=args.num_workers_test,
+        pin_memory=True,
     )
 
     # For mixed precision training we cast the text_encoder and vae weights to half-precision
@@ -1,31 +1,12 @@
 import torch
-import torchvision.transforms.functional as F
 
-import torch
-import torchvision
-import torchvision.transforms as T
-from PIL import Image
-transform = T.ToPILImage()
-
-def compose_img(gt_img, fake_img, im_parse):
-
-    seg_head = torch.logical_or(im_parse == 1, im_parse == 2)
-    seg_head = torch.logical_or(seg_head, im_parse == 4)
-    seg_head = torch.logical_or(seg_head, im_parse == 13)
 
-    # img = transform(fake_img)
-    # img.save("fake_img.jpg")
+def compose_img(gt_img, fake_img_t, im_parse):
 
-    
-    
-
-    true_head = gt_img * seg_head
-    true_parts = true_head
+    seg_head = (im_parse == 1) | (im_parse == 2) | (im_parse == 4) | (im_parse == 13)
 
-    # img = transform(true_head)
-    # img.save("true_head.jpg")
-    
-    generated_body = (F.pil_to_tensor(fake_img).cuda() / 255) * (~(seg_head))
+    true_parts = gt_img * seg_head
+    generated_body = fake_img_t * ~seg_head
 
     return true_parts + generated_body
 
@@ -1,13 +1,23 @@
 import os
 from tqdm import tqdm
+import numpy as np
 import torch
 
 import torchvision.transforms as T
 from diffusers.pipeline_utils import DiffusionPipeline
+from PIL import Image
 from torch.utils.data import DataLoader
 from src.utils.image_composition import compose_img, compose_img_dresscode
 
 
+def pil_to_device_tensor(img: Image.Image, device: torch.device) -> torch.Tensor:
+    """ Convert a PIL image to a CHW float tensor in [0,1] placed on device.
+    The uint8 image is copied to the device before the float conversion, so only a quarter of the bytes move.
+    """
+    img = torch.from_numpy(np.array(img))
+    return img.to(device).permute(2, 0, 1).float().div_(255)
+
+
 @torch.inference_mode()
 def generate_images_from_mgd_pipe(
     test_order: bool,
@@ -107,7 +117,8 @@ def generate_images_from_mgd_pipe(
             for i in range(len(generated_images)):
                 model_i = model_img[i] * 0.5 + 0.5
                 if dataset == "vitonhd":
-                    final_img = compose_img(model_i, generated_images[i], batch['im_parse'][i])
+                    final_img = compose_img(model_i, pil_to_device_tensor(generated_images[i], model_img.device),
+                                            batch['im_parse'][i])
                 else: # dataset == Dresscode
                     face = batch["stitch_label"][i].to(model_img.device)
                     face = T.functional.resize(face, 
@@ -122,7 +133,7 @@ def generate_images_from_mgd_pipe(
                     
                     final_img = compose_img_dresscode(
                         gt_img = model_i, 
-                        fake_img = T.functional.to_tensor(generated_images[i]).to(model_img.device), 
+                        fake_img = pil_to_device_tensor(generated_images[i], model_img.device), 
                         im_head = face
                         )
                 
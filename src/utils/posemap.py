@@ -34,6 +34,39 @@ def kpoint_to_heatmap(kpoint, shape, sigma):
     return torch.Tensor(heatmap)
 
 
+def kpoints_to_heatmaps(kpoints, shape, sigma):
+    """Converts a set of 2D keypoints to gaussian heatmaps at once
+
+    The gaussian is separable, so every heatmap is the outer product of a row and a column profile
+    and the exponential is evaluated only H + W times per keypoint instead of on the whole grid.
+
+    Parameters
+    ----------
+    kpoints: np.array
+        Nx2 coordinates of keypoints [x, y].
+    shape: tuple
+        Heatmap dimension (HxW).
+    sigma: float
+        Variance value of the gaussian.
+
+    Returns
+    -------
+    heatmaps: torch.Tensor
+        N gaussian heatmaps NxHxW, equal to stacking kpoint_to_heatmap over the keypoints.
+    """
+    map_h = shape[0]
+    map_w = shape[1]
+    x = kpoints[:, 0:1]
+    y = kpoints[:, 1:2]
+    heat_x = np.exp(-(np.arange(map_w) - x) ** 2 / sigma ** 2)
+    heat_y = np.exp(-(np.arange(map_h) - y) ** 2 / sigma ** 2)
+    norm = heat_x.max(axis=1) * heat_y.max(axis=1) + np.finfo('float32').eps
+    # keypoints that are not detected get an empty heatmap
+    heat_y *= (np.any(kpoints > 0, axis=1) / norm)[:, None]
+    heatmaps = heat_y.astype(np.float32)[:, :, None] * heat_x.astype(np.float32)[:, None, :]
+    return torch.from_numpy(heatmaps)
+
+
 def get_coco_body25_mapping():
     #left numbers are coco format while right numbers are body25 format
     return {